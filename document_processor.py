@@ -1,89 +1,214 @@
 import os
+import hashlib
+import pickle
 import fitz  # PyMuPDF
-import base64
-import pandas as pd
 import openpyxl
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
 from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
+
+DOCS_CACHE_FILE = os.path.join("chroma_data", "docs_cache.pkl")
+# Bump when the structure of the cached documents or images changes
+DOCS_CACHE_VERSION = 4
+
+
+# Embedded PDF images smaller than this many pixels (spacers, bullets, borders) are skipped
+MIN_IMAGE_PIXELS = int(os.environ.get("MIN_IMAGE_PIXELS", 64 * 64))
+
+CHUNK_SIZE = 1000
+_TEXT_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=200)
+# Documents no longer than CHUNK_SIZE (such as Excel product rows) need no splitting, so
+# worker processes are only started when this many characters of text need splitting.
+PARALLEL_CHUNKING_MIN_CHARS = 5_000_000
+
+
+@dataclass(slots=True)
+class ImageRecord:
+    """An image extracted from a PDF page or an Excel product row, with its search metadata."""
+    image_data: bytes | None  # None when the retriever reads the bytes lazily from disk
+    source: str
+    page: int | None = None
+    pages: list = field(default_factory=list)
+    row_index: int | None = None
+    product_name: str = ''
+    label: str = ''
+    description: str = ''
+    details: str = ''
+
+
+def _num_workers():
+    """Returns the number of worker processes used to load documents."""
+    configured = os.environ.get("LOAD_DOCUMENTS_NUM_WORKERS")
+    if configured:
+        return max(1, int(configured))
+    return min(os.cpu_count() or 1, 6)
+
+
+def _process_file(file_path):
+    """Loads a single PDF or Excel file. Module-level so it can run in a worker process."""
+    processor = DocumentProcessor()
+    if file_path.lower().endswith(".pdf"):
+        return processor.process_pdf(file_path)
+    return processor.process_excel_file(file_path)
+
+
+def _split_documents(documents):
+    """Splits a batch of documents into chunks. Module-level so it can run in a worker process."""
+    return _TEXT_SPLITTER.split_documents(documents)
+
 
 class DocumentProcessor:
+    def _data_dir(self):
+        """Returns the data directory, creating it if needed."""
+        data_dir = os.path.join(os.path.dirname(__file__), "data")
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        return data_dir
+
+    def data_signature(self):
+        """Returns a hash of the data directory's file names and modification times."""
+        data_dir = self._data_dir()
+        entries = sorted((name, os.path.getmtime(os.path.join(data_dir, name))) for name in os.listdir(data_dir))
+        return hashlib.sha256(repr((DOCS_CACHE_VERSION, entries)).encode()).hexdigest()
+
+    def load_cached_documents(self, signature=None):
+        """Returns the documents and images from the on-disk cache, reprocessing the data directory only if it changed."""
+        signature = signature or self.data_signature()
+        try:
+            with open(DOCS_CACHE_FILE, "rb") as f:
+                cached = pickle.load(f)
+            if cached.get('signature') == signature:
+                return cached['documents'], cached['images_data']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Could not read documents cache {DOCS_CACHE_FILE}: {e}")
+
+        documents, images_data = self.load_documents()
+        try:
+            os.makedirs(os.path.dirname(DOCS_CACHE_FILE), exist_ok=True)
+            with open(DOCS_CACHE_FILE, "wb") as f:
+                pickle.dump({'signature': signature, 'documents': documents, 'images_data': images_data}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            print(f"Could not write documents cache {DOCS_CACHE_FILE}: {e}")
+        return documents, images_data
+
     def load_documents(self):
         """Loads text and images from all PDF and Excel files in the data directory."""
         documents = []
         images_data = []
-        data_dir = os.path.join(os.path.dirname(__file__), "data")
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir)
+        data_dir = self._data_dir()
 
-        # Process PDF files first
-        for file in os.listdir(data_dir):
-            if file.lower().endswith(".pdf"):
-                file_path = os.path.join(data_dir, file)
-                try:
-                    pdf_docs, pdf_images = self.process_pdf(file_path)
-                    documents.extend(pdf_docs)
-                    images_data.extend(pdf_images)
-                    print(f"Loaded {len(pdf_docs)} docs and {len(pdf_images)} images from {file}")
-                except Exception as e:
-                    print(f"Error loading PDF {file_path}: {str(e)}")
+        # One directory pass, partitioned so PDF files come first, then Excel files
+        pdf_files, excel_files = [], []
+        with os.scandir(data_dir) as entries:
+            for entry in entries:
+                name = entry.name.lower()
+                if name.endswith(".pdf"):
+                    pdf_files.append(entry.path)
+                elif name.endswith((".xlsx", ".xls")):
+                    excel_files.append(entry.path)
+        files = sorted(pdf_files) + sorted(excel_files)
+        if not files:
+            return documents, images_data
 
-        # Then process Excel files
-        for file in os.listdir(data_dir):
-            if file.lower().endswith((".xlsx", ".xls")):
-                file_path = os.path.join(data_dir, file)
+        with ProcessPoolExecutor(max_workers=min(_num_workers(), len(files))) as executor:
+            futures = [executor.submit(_process_file, file_path) for file_path in files]
+            for file_path, future in zip(files, futures):
                 try:
-                    excel_docs, excel_images = self.process_excel_file(file_path)
-                    documents.extend(excel_docs)
-                    images_data.extend(excel_images)
-                    print(f"Loaded {len(excel_docs)} docs and {len(excel_images)} images from {file}")
+                    file_docs, file_images = future.result()
+                    documents.extend(file_docs)
+                    images_data.extend(file_images)
+                    print(f"Loaded {len(file_docs)} docs and {len(file_images)} images from {os.path.basename(file_path)}")
                 except Exception as e:
-                    print(f"Error loading Excel {file_path}: {str(e)}")
+                    print(f"Error loading {file_path}: {str(e)}")
 
         return documents, images_data
 
     def process_pdf(self, pdf_path):
-        """Extracts all text and images from a given PDF file."""
-        text_docs = PyPDFLoader(pdf_path).load()
+        """Extracts all text and images from a given PDF file in a single PyMuPDF pass."""
+        text_docs = []
         images = []
+        source = os.path.basename(pdf_path)
+        # Repeated logos and diagrams are stored once, with every page they appear on
+        seen_xrefs = {}
+        seen_hashes = {}
+        doc = fitz.open(pdf_path, filetype="pdf")
+        # Pages are walked serially on purpose: PyMuPDF is not thread-safe and holds
+        # the GIL while extracting, so a thread pool here would add locking without
+        # speedup. Parallelism comes from load_documents running one process per file.
         try:
-            doc = fitz.open(pdf_path)
-            for page_num in range(len(doc)):
-                for img_index, img in enumerate(doc.get_page_images(page_num)):
-                    xref = img[0]
-                    base_image = doc.extract_image(xref)
-                    image_bytes = base_image["image"]
-                    img_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                    images.append({
-                        'image_data': img_base64,
-                        'source': os.path.basename(pdf_path),
-                        'page': page_num + 1,
-                        'description': f"Image {img_index + 1} from page {page_num + 1} of {os.path.basename(pdf_path)}"
-                    })
+            for page in doc.pages():
+                page_num = page.number + 1
+                text_docs.append(Document(page_content=page.get_text("text"),
+                                          metadata={'source': source, 'page': page_num}))
+                try:
+                    for img_index, img in enumerate(page.get_images(full=False)):
+                        xref, width, height = img[0], img[2], img[3]
+                        if width * height < MIN_IMAGE_PIXELS:
+                            continue
+                        if xref in seen_xrefs:
+                            self._add_image_page(images[seen_xrefs[xref]], page_num)
+                            continue
+                        image_bytes = doc.extract_image(xref)["image"]
+                        digest = hashlib.sha256(image_bytes).digest()
+                        if digest in seen_hashes:
+                            seen_xrefs[xref] = seen_hashes[digest]
+                            self._add_image_page(images[seen_hashes[digest]], page_num)
+                            continue
+                        seen_xrefs[xref] = seen_hashes[digest] = len(images)
+                        images.append(ImageRecord(
+                            image_data=image_bytes,
+                            source=source,
+                            page=page_num,
+                            pages=[page_num],
+                            description=f"Image {img_index + 1} from page {page_num} of {source}"
+                        ))
+                except Exception as e:
+                    print(f"Could not extract images from page {page_num} of {pdf_path}: {e}")
+        finally:
             doc.close()
-        except Exception as e:
-            print(f"Could not extract images from {pdf_path}: {e}")
         return text_docs, images
 
+    @staticmethod
+    def _add_image_page(image, page_num):
+        """Records another page on which an already extracted image appears."""
+        if page_num not in image.pages:
+            image.pages.append(page_num)
+
     def process_excel_file(self, excel_path):
         """Extracts documents and embedded images from each row of an Excel file."""
         documents = []
         images_data = []
         try:
-            wb = openpyxl.load_workbook(excel_path)
+            # A single openpyxl pass provides both the cell values and the embedded images
+            wb = openpyxl.load_workbook(excel_path, data_only=True)
             ws = wb.active
-            df = pd.read_excel(excel_path).fillna('')
             embedded_images = self._extract_images_from_excel(ws)
 
-            for index, row in df.iterrows():
-                product_name = str(row.get('Product Name', '')).strip()
+            rows = ws.iter_rows(values_only=True)
+            header = next(rows, ())
+            columns = {str(name): i for i, name in enumerate(header) if name is not None}
+
+            def cell(values, name, default):
+                i = columns.get(name)
+                if i is None or i >= len(values):
+                    return default
+                return '' if values[i] is None else values[i]
+
+            for index, values in enumerate(rows):
+                product_name = str(cell(values, 'Product Name', '')).strip()
                 if not product_name:
                     continue
+                category = cell(values, 'Product Category', 'N/A')
+                subtype = cell(values, 'Product subtype', 'N/A')
 
-                product_text = f"Product Category: {row.get('Product Category', 'N/A')}\n" \
+                product_text = f"Product Category: {category}\n" \
                                f"Product Name: {product_name}\n" \
-                               f"Product Subtype: {row.get('Product subtype', 'N/A')}\n" \
-                               f"Product Configuration: {row.get('Product Configuration', 'N/A')}"
+                               f"Product Subtype: {subtype}\n" \
+                               f"Product Configuration: {cell(values, 'Product Configuration', 'N/A')}"
 
                 metadata = {
                     'source': os.path.basename(excel_path),
@@ -94,35 +219,49 @@ class DocumentProcessor:
                 documents.append(doc)
 
                 if index < len(embedded_images):
-                    img_b64 = embedded_images[index]
-                    if img_b64:
-                        images_data.append({
-                            'image_data': img_b64,
-                            'source': os.path.basename(excel_path),
-                            'row_index': index,
-                            'label': product_name,
-                            'details': f"Category: {row.get('Product Category', '')} | Subtype: {row.get('Product subtype', '')}",
-                            'description': f"Product image for {product_name}",
-                            'product_name': product_name
-                        })
+                    image_bytes = embedded_images[index]
+                    if image_bytes:
+                        images_data.append(ImageRecord(
+                            image_data=image_bytes,
+                            source=os.path.basename(excel_path),
+                            row_index=index,
+                            label=product_name,
+                            details=f"Category: {category} | Subtype: {subtype}",
+                            description=f"Product image for {product_name}",
+                            product_name=product_name
+                        ))
         except Exception as e:
             print(f"Error processing Excel file {excel_path}: {e}")
         return documents, images_data
 
     def _extract_images_from_excel(self, worksheet):
-        """Extracts all embedded images from an Excel worksheet in order."""
+        """Extracts the raw bytes of all embedded images from an Excel worksheet in order."""
         images = []
         for img in worksheet._images:
             try:
-                img_data = img._data()
-                img_base64 = base64.b64encode(img_data).decode('utf-8')
-                images.append(img_base64)
+                images.append(img._data())
             except Exception as e:
                 print(f"Could not extract an embedded image: {e}")
                 images.append(None)
         return images
 
     def chunk_documents(self, documents):
-        """Splits documents into smaller chunks for processing."""
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        return text_splitter.split_documents(documents)
\ No newline at end of file
+        """Splits documents into smaller chunks for processing, in parallel for large corpora."""
+        num_workers = _num_workers()
+        text_to_split = sum(len(doc.page_content) for doc in documents if len(doc.page_content) > CHUNK_SIZE)
+        if num_workers == 1 or text_to_split < PARALLEL_CHUNKING_MIN_CHARS:
+            return _split_documents(documents)
+
+        # Contiguous batches of roughly equal text keep the chunks in document order
+        target = -(-sum(len(doc.page_content) for doc in documents) // num_workers)
+        batches, batch, batch_chars = [], [], 0
+        for doc in documents:
+            batch.append(doc)
+            batch_chars += len(doc.page_content)
+            if batch_chars >= target:
+                batches.append(batch)
+                batch, batch_chars = [], 0
+        if batch:
+            batches.append(batch)
+        with ProcessPoolExecutor(max_workers=len(batches)) as executor:
+            return [chunk for chunks in executor.map(_split_documents, batches) for chunk in chunks]
@@ -0,0 +1,80 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from array import array
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_CACHE_FILE = os.path.join("chroma_data", "embedding_cache.sqlite")
+# Keeps each "WHERE key IN (...)" lookup under SQLite's bound-parameter limit
+_LOOKUP_BATCH_SIZE = 500
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model with a persistent, content-addressed cache so that
+    repeated queries and unchanged chunks are embedded only once.
+    """
+    def __init__(self, embeddings, model, path=EMBEDDING_CACHE_FILE):
+        self.embeddings = embeddings
+        self.model = model
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+
+    def _key(self, kind, text):
+        """Hashes the model, the embedding kind (documents and queries embed differently) and the text."""
+        return hashlib.blake2b(f"{self.model}\x00{kind}\x00{text}".encode(), digest_size=32).hexdigest()
+
+    def _lookup(self, keys):
+        """Returns a dict of the cached vectors for whichever of the keys are present."""
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), _LOOKUP_BATCH_SIZE):
+                batch = keys[start:start + _LOOKUP_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch)
+                found.update((key, array('d', vector).tolist()) for key, vector in rows)
+        return found
+
+    def _store(self, vectors_by_key):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array('d', vector).tobytes()) for key, vector in vectors_by_key.items()]
+            )
+
+    def _embed_cached(self, kind, texts, embed_missing):
+        """Returns vectors for texts, calling embed_missing in one batch for those not cached."""
+        keys = [self._key(kind, text) for text in texts]
+        vectors = self._lookup(keys)
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if missing:
+            new_vectors = dict(zip(missing, embed_missing(list(missing.values()))))
+            self._store(new_vectors)
+            vectors.update(new_vectors)
+        return [vectors[key] for key in keys]
+
+    def embed_documents(self, texts, **kwargs):
+        """Embeds only the texts missing from the cache; extra arguments go to the wrapped model."""
+        return self._embed_cached("document", texts, lambda missing: self.embeddings.embed_documents(missing, **kwargs))
+
+    def embed_queries(self, texts):
+        """
+        Embeds several queries, in one request for whichever are not cached. Uses the
+        wrapped model's batch call with the retrieval_query task type, which is what
+        GoogleGenerativeAIEmbeddings.embed_query uses for a single query.
+        """
+        return self._embed_cached(
+            "query", texts, lambda missing: self.embeddings.embed_documents(missing, task_type="retrieval_query")
+        )
+
+    def embed_query(self, text):
+        key = self._key("query", text)
+        cached = self._lookup([key])
+        if key in cached:
+            return cached[key]
+        vector = self.embeddings.embed_query(text)
+        self._store({key: vector})
+        return vector
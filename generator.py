@@ -1,14 +1,42 @@
 import os
+import hashlib
+import threading
 import google.generativeai as genai
 import pandas as pd
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Starts streamed model requests in the background so several can be in flight at once
+_executor = ThreadPoolExecutor(max_workers=4)
+
+# LRU cache of complete responses keyed on a hash of the model and prompt. It lives at
+# module level because main() builds a new ResponseGenerator on every Streamlit rerun.
+RESPONSE_CACHE_SIZE = 256
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+def _get_cached_response(key):
+    with _response_cache_lock:
+        if key not in _response_cache:
+            return None
+        _response_cache.move_to_end(key)
+        return _response_cache[key]
+
+def _cache_response(key, text):
+    with _response_cache_lock:
+        _response_cache[key] = text
+        _response_cache.move_to_end(key)
+        if len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
 
 class ResponseGenerator:
     def __init__(self, api_key, model="gemini-2.0-flash"):
         genai.configure(api_key=api_key)
+        self.model_name = model
         self.model = genai.GenerativeModel(model)
 
     def generate_direct_response(self, query):
-            """Generates a standard, non-contextual response from the model."""
+            """Streams a standard, non-contextual response from the model as text chunks."""
             prompt = f"""
             You are a helpful and knowledgeable AI assistant. Your task is to provide a comprehensive and detailed answer to the user's question.
             - Elaborate on the main topic of the question.
@@ -22,17 +50,41 @@ class ResponseGenerator:
 
             **Your Detailed Answer:**
             """
+            return self._stream_response(prompt, "direct", "I encountered an error while generating a standard response.")
+
+    def _stream_response(self, prompt, label, error_message):
+        """
+        Sends a streamed request in the background and returns an iterator over
+        the response text. The request is already in flight when this returns.
+        Identical prompts are answered from the response cache without a request.
+        """
+        cache_key = hashlib.sha256(f"{self.model_name}\x00{prompt}".encode()).hexdigest()
+        cached = _get_cached_response(cache_key)
+        if cached is not None:
+            return iter([cached])
+
+        response_future = _executor.submit(self.model.generate_content, prompt, stream=True)
+
+        def text_chunks():
+            parts = []
             try:
-                response = self.model.generate_content(prompt)
-                return response.text
+                for chunk in response_future.result():
+                    parts.append(chunk.text)
+                    yield chunk.text
             except Exception as e:
-                print(f"Error during direct response generation: {e}")
-                return "I encountered an error while generating a standard response."
+                print(f"Error during {label} response generation: {e}")
+                yield error_message
+                return
+            _cache_response(cache_key, "".join(parts))
+
+        return text_chunks()
 
     def generate_response(self, query, context, images=None, product_info=None, web_context=None):
         """
         Generates a dictionary containing a contextual response (from documents and web)
-        and a direct response (standard model answer).
+        and a direct response (standard model answer). Each value is an iterator of text
+        chunks; both requests are sent at once, so the direct answer is generated while
+        the contextual one is being read.
         """
         context_text = self._build_context_text(context)
         image_context = self._build_image_context(images)
@@ -82,19 +134,12 @@ class ResponseGenerator:
         **Your Expert Answer:**
         """
         
-        contextual_response = "Error: Could not generate contextual response."
-        try:
-            response = self.model.generate_content(contextual_prompt)
-            contextual_response = response.text
-        except Exception as e:
-            print(f"Error during contextual response generation: {e}")
-            contextual_response = "I encountered an error while processing your request with the provided documents."
-
-        direct_response = self.generate_direct_response(query)
-
         return {
-            "contextual": contextual_response,
-            "direct": direct_response
+            "contextual": self._stream_response(
+                contextual_prompt, "contextual",
+                "I encountered an error while processing your request with the provided documents."
+            ),
+            "direct": self.generate_direct_response(query)
         }
 
     def _build_context_text(self, context):
@@ -110,9 +155,9 @@ class ResponseGenerator:
         image_parts = []
         for i, image in enumerate(images):
             image_parts.append(f"""
-            Image {i+1} Context (from {image.get('source', 'N/A')}, page {image.get('page', 'N/A')}):
-            - Product Mentioned: {image.get('product_name') or 'N/A'}
-            - Description: {image.get('description') or 'No description available.'}
+            Image {i+1} Context (from {image.source}, page {image.page or 'N/A'}):
+            - Product Mentioned: {image.product_name or 'N/A'}
+            - Description: {image.description or 'No description available.'}
             """)
         return "\n".join(image_parts)
 
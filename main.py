@@ -9,26 +9,49 @@ try:
 except ImportError:
     pass
     
-import base64
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from document_processor import DocumentProcessor
 from retriever import Retriever
 from generator import ResponseGenerator
 from web_search import WebSearch
 
+# Runs the web search in the background while documents are retrieved locally
+_executor = ThreadPoolExecutor(max_workers=2)
+
 def display_image(image_data):
-    """Displays an image from base64 data with a caption."""
+    """Displays an ImageRecord with a caption."""
     try:
-        img_bytes = base64.b64decode(image_data['image_data'])
-        caption = image_data.get('label') or image_data.get('description', 'Image')
-        st.image(img_bytes, caption=caption, use_container_width=True)
-        details = image_data.get('details')
+        caption = image_data.label or image_data.description or 'Image'
+        st.image(image_data.image_data, caption=caption, use_container_width=True)
+        details = image_data.details
         if details:
             st.markdown(f"**Details:** {details}")
     except Exception as e:
         st.error(f"Error displaying image: {e}")
 
+@st.cache_resource(show_spinner=False)
+def index_documents(data_signature):
+    """
+    Builds the vector store and image data from the data directory unless they were
+    already built from data with this signature. cache_resource runs this once per
+    signature, making sessions that start during indexing wait instead of repeating it.
+    Returns False if the data directory holds no documents.
+    """
+    processor = DocumentProcessor()
+    retriever = Retriever()
+    # The vector store and image data persist across sessions, so the documents and
+    # their image bytes are only loaded, and held in memory, to index new data.
+    if retriever.is_indexed(data_signature):
+        return True
+    documents, images_data = processor.load_cached_documents(data_signature)
+    if not documents and not images_data:
+        return False
+    chunks = processor.chunk_documents(documents)
+    retriever.create_vector_store(chunks, images_data, data_signature)
+    return True
+
 def main():
     load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
     
@@ -56,13 +79,9 @@ def main():
 
     if "data_loaded" not in st.session_state:
         with st.spinner("First-time setup: Processing all documents, please wait..."):
-            st.session_state.all_documents, st.session_state.all_images_data = processor.load_documents()
-            if not st.session_state.all_documents and not st.session_state.all_images_data:
+            if not index_documents(processor.data_signature()):
                 st.warning("No documents found in 'data' folder. Please add PDF or Excel files.")
                 return
-            
-            chunks = processor.chunk_documents(st.session_state.all_documents)
-            retriever.create_vector_store(chunks, st.session_state.all_images_data)
             st.session_state.data_loaded = True
             st.success("All documents processed and ready!")
 
@@ -83,40 +102,40 @@ def main():
 
         with st.chat_message("assistant"):
             with st.spinner("Searching documents, the web, and formulating responses..."):
-                context = retriever.retrieve_relevant_docs(prompt)
-                relevant_images = retriever.get_relevant_images(prompt, context)
+                web_future = _executor.submit(web_search_tool.search, prompt) if web_search_tool else None
+
+                context, relevant_images = retriever.retrieve_docs_and_images(prompt)
 
                 web_context = None
-                if web_search_tool:
+                if web_future:
                     with st.spinner("Performing web search..."):
-                        web_context = web_search_tool.search(prompt)
+                        web_context = web_future.result()
 
                 response_data = generator.generate_response(prompt, context, relevant_images, web_context=web_context)
-                contextual_response = response_data["contextual"]
-                direct_response = response_data["direct"]
-
-                st.markdown("### 📝 Answer from Your Documents & Web")
-                st.markdown(contextual_response)
-                st.markdown("---")
-                st.markdown("### 💡 General Answer from Gemini")
-                st.markdown(direct_response)
-
-                if relevant_images:
-                    st.write("**Relevant Image(s) from Documents:**")
-                    for img in relevant_images:
-                        display_image(img)
-                
-                # Combine for chat history
-                full_response_for_history = (
-                    f"### 📝 Answer from Your Documents & Web\n{contextual_response}\n\n"
-                    f"---\n\n"
-                    f"### 💡 General Answer from Gemini\n{direct_response}"
-                )
-                
-                assistant_message = {"role": "assistant", "content": full_response_for_history}
-                if relevant_images:
-                    assistant_message["images"] = relevant_images
-                st.session_state.messages.append(assistant_message)
+
+            # Render the answers as they stream in, outside the spinner
+            st.markdown("### 📝 Answer from Your Documents & Web")
+            contextual_response = st.write_stream(response_data["contextual"])
+            st.markdown("---")
+            st.markdown("### 💡 General Answer from Gemini")
+            direct_response = st.write_stream(response_data["direct"])
+
+            if relevant_images:
+                st.write("**Relevant Image(s) from Documents:**")
+                for img in relevant_images:
+                    display_image(img)
+            
+            # Combine for chat history
+            full_response_for_history = (
+                f"### 📝 Answer from Your Documents & Web\n{contextual_response}\n\n"
+                f"---\n\n"
+                f"### 💡 General Answer from Gemini\n{direct_response}"
+            )
+            
+            assistant_message = {"role": "assistant", "content": full_response_for_history}
+            if relevant_images:
+                assistant_message["images"] = relevant_images
+            st.session_state.messages.append(assistant_message)
 
 if __name__ == "__main__":
     main()
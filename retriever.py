@@ -1,137 +1,461 @@
 import os
+import mmap
+import dataclasses
+import functools
+import re
+import string
+import heapq
 import pickle
+import tempfile
+import hashlib
+import time
+import queue
+import threading
+from collections import defaultdict
+from concurrent.futures import Future
+from langchain.schema import Document
 from langchain_chroma import Chroma
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from embedding_cache import CachedEmbeddings
+
+# Score contributed by a keyword found in each searchable image field
+FIELD_WEIGHTS = (('description', 2), ('label', 5), ('product_name', 10))
+
+# Apostrophes are dropped so "what's" becomes the stop word "whats"; other punctuation
+# becomes a space so "co-sensor?" splits into "co" and "sensor" like indexed fields do.
+_PUNCTUATION_TABLE = str.maketrans(
+    string.punctuation.replace("'", ""), " " * (len(string.punctuation) - 1), "'"
+)
+
+def _normalize(text):
+    """Lowercases text and strips punctuation as described for _PUNCTUATION_TABLE."""
+    return text.lower().translate(_PUNCTUATION_TABLE)
+
+def _tokenize(text):
+    """Splits normalized text into word tokens, so "EnergyTech-202-CO-Sensor" yields "co" and "sensor"."""
+    return re.findall(r"\w+", text)
+
+def _context_key(source, page=None, row_index=None):
+    """
+    Links an image to the text chunk it belongs to: the Excel product row if it has
+    one, otherwise the PDF page. Retrieved chunks and images map to the same keys.
+    """
+    if row_index is not None:
+        return (source, 'row', row_index)
+    return (source, 'page', page)
+
+EMBEDDING_MODEL = "models/embedding-001"
+
+# Image metadata is pickled apart from the image bytes, which are concatenated into a
+# blob file and memory-mapped, so loading the metadata never reads the images themselves.
+IMAGES_DATA_FILE = os.path.join("chroma_data", "images_data.pkl")
+IMAGES_BLOB_FILE = os.path.join("chroma_data", "images_data.bin")
+
+# Number of chunks sent per embedding request and per Chroma insert
+EMBED_BATCH_SIZE = 100
+
+# Data signature the vector store and image data were last built from
+INDEXED_SIGNATURE_FILE = os.path.join("chroma_data", "indexed_signature")
+
+def _chunk_id(chunk):
+    """Derives a chunk's id from its source, page or row, and text, so re-indexing replaces it instead of adding a copy."""
+    meta = chunk.metadata
+    key = f"{meta.get('source')}\x00{meta.get('page')}\x00{meta.get('row_index')}\x00{chunk.page_content}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+# main() builds a new Retriever on every Streamlit rerun, so the embeddings client and the
+# Chroma handle are memoized per process to reuse their connections and avoid re-initializing.
+@functools.lru_cache(maxsize=1)
+def _get_embeddings(model, api_key):
+    """Returns the Google embeddings model behind a persistent cache of computed vectors."""
+    embeddings = GoogleGenerativeAIEmbeddings(model=model, google_api_key=api_key)
+    return CachedEmbeddings(embeddings, model)
+
+@functools.lru_cache(maxsize=1)
+def _get_vector_store(persist_directory, model, api_key):
+    """Returns the Chroma store persisted in persist_directory."""
+    return Chroma(persist_directory=persist_directory, embedding_function=_get_embeddings(model, api_key))
+
+# Queries arriving from concurrent sessions within this window (seconds) share one
+# embedding request and one Chroma query, up to QUERY_BATCH_MAX queries per batch.
+QUERY_BATCH_WINDOW = 0.01
+QUERY_BATCH_MAX = 16
+# Longest a caller waits for its batched search (seconds) before giving up
+QUERY_TIMEOUT = 60
+
+class _QueryBatcher:
+    """Micro-batches similarity searches from concurrent callers on a background thread."""
+    def __init__(self, vector_store):
+        self.vector_store = vector_store
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, query, k):
+        """Queues a search and returns a Future for the same (Document, distance) list as similarity_search_with_score."""
+        future = Future()
+        self._queue.put((query, k, future))
+        return future
+
+    def search(self, query, k):
+        """Runs a search and waits for its result."""
+        return self.submit(query, k).result(timeout=QUERY_TIMEOUT)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + QUERY_BATCH_WINDOW
+            while len(batch) < QUERY_BATCH_MAX:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # This thread serves every search in the process, so a failed batch must
+            # neither end it nor leave any of its callers waiting.
+            try:
+                self._search_batch(batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _search_batch(self, batch):
+        try:
+            vectors = self.vector_store.embeddings.embed_queries([query for query, _, _ in batch])
+            results = self.vector_store._collection.query(
+                query_embeddings=vectors,
+                n_results=max(k for _, k, _ in batch),
+                include=["documents", "metadatas", "distances"]
+            )
+            batch_results = [
+                [
+                    (Document(page_content=text, metadata=metadata or {}), distance)
+                    for text, metadata, distance in zip(results["documents"][i], results["metadatas"][i], results["distances"][i])
+                ][:k]
+                for i, (_, k, _) in enumerate(batch)
+            ]
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), result in zip(batch, batch_results):
+            future.set_result(result)
+
+@functools.lru_cache(maxsize=1)
+def _get_query_batcher(persist_directory, model, api_key):
+    return _QueryBatcher(_get_vector_store(persist_directory, model, api_key))
+
+class _ImageIndex:
+    """
+    The image metadata with parallel per-image lists (normalized label and product
+    name, context keys, Excel flag) indexed like images_data, plus inverted indexes
+    from each token and each context key to the images they belong to.
+    """
+    # Distinct query tokens whose substring matches are remembered
+    MATCH_CACHE_SIZE = 4096
+
+    def __init__(self, images_data, spans):
+        self.images_data = images_data
+        self.spans = spans
+        self.blob = None
+        self._match_cache = {}
+        self.label_lc = []
+        self.pname_lc = []
+        self.context_keys = []
+        self.has_row_index = []
+        self.inv_index = defaultdict(list)
+        self.context_index = defaultdict(list)
+        for idx, img in enumerate(images_data):
+            self.label_lc.append(_normalize(img.label))
+            self.pname_lc.append(_normalize(img.product_name))
+            self.has_row_index.append(img.row_index is not None)
+            for field, weight in FIELD_WEIGHTS:
+                for token in set(_tokenize(_normalize(getattr(img, field)))):
+                    self.inv_index[token].append((idx, weight))
+            # A deduplicated PDF image lists every page it appears on
+            if img.row_index is not None:
+                context_keys = frozenset([_context_key(img.source, row_index=img.row_index)])
+            else:
+                context_keys = frozenset(_context_key(img.source, page) for page in img.pages or [img.page])
+            self.context_keys.append(context_keys)
+            for key in context_keys:
+                self.context_index[key].append(idx)
+        if any(length for _, length in spans):
+            with open(IMAGES_BLOB_FILE, "rb") as f:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def matches(self, token):
+        """
+        Returns the (image, field weight) pairs for every indexed token containing token,
+        so "boiler" matches "boilers" and "tech" matches "energytech" as the original
+        substring test did. Scans the vocabulary, not the images, and caches the result.
+        """
+        pairs = self._match_cache.get(token)
+        if pairs is None:
+            if len(self._match_cache) >= self.MATCH_CACHE_SIZE:
+                self._match_cache.clear()
+            pairs = frozenset(
+                pair for indexed, indexed_pairs in self.inv_index.items() if token in indexed for pair in indexed_pairs
+            )
+            self._match_cache[token] = pairs
+        return pairs
+
+    def with_image_bytes(self, idx):
+        """Returns the image at idx with its bytes read from the memory-mapped blob file."""
+        offset, length = self.spans[idx]
+        data = self.blob[offset:offset + length] if length else b""
+        return dataclasses.replace(self.images_data[idx], image_data=data)
+
+# main() builds a new Retriever on every Streamlit rerun, so the loaded image metadata
+# and its index are memoized per process, keyed on the pickle's modification time.
+@functools.lru_cache(maxsize=1)
+def _load_image_index(path, mtime):
+    """Loads the image metadata from its pickle file and indexes it; image bytes are read on demand."""
+    if mtime is None:
+        return _ImageIndex([], [])
+    with open(path, "rb") as f:
+        saved = pickle.load(f)
+    return _ImageIndex(saved['records'], saved['spans'])
 
 class Retriever:
     def __init__(self):
         self.vector_store = None
-        self.images_data = []
+        self._images = None
+        self._excel_docs_source = None
+        self._excel_docs_index = {}
         # --- CHANGE START ---
         # Added a set of common stop words to ignore during search
         self.stop_words = set([
             "a", "about", "an", "are", "as", "at", "be", "by", "for", "from",
             "how", "in", "is", "it", "of", "on", "or", "that", "the", "this",
             "to", "was", "what", "when", "where", "who", "will", "with", "the",
-            "tell", "me", "what's", "whats", "what is"
+            "tell", "me", "what's", "whats", "what is", "how do i", "can you", "could you"
         ])
         # --- CHANGE END ---
+        # Multi-word entries never equal a single word, so they are matched as
+        # phrases over the query's word sequence (longest first) instead.
+        self._stop_phrases = {tuple(entry.split()) for entry in self.stop_words if " " in entry}
+        self._max_stop_phrase_len = max((len(phrase) for phrase in self._stop_phrases), default=1)
+
+    def is_indexed(self, signature):
+        """Returns True if the vector store and image data were already built from data with this signature."""
+        try:
+            with open(INDEXED_SIGNATURE_FILE) as f:
+                return f.read() == signature
+        except FileNotFoundError:
+            return False
+
+    def create_vector_store(self, chunks, images_data=None, signature=None):
+        """
+        Creates a vector store for text and saves the image data list. Chunks are upserted
+        under content-derived ids, and chunks no longer in the data are deleted, so
+        re-indexing never duplicates them. The signature, if given, is recorded for is_indexed.
+        """
+        self.vector_store = _get_vector_store("chroma_data", EMBEDDING_MODEL, os.environ.get('GOOGLE_API_KEY'))
+        embeddings = self.vector_store.embeddings
 
-    def create_vector_store(self, chunks, images_data=None):
-        """Creates a vector store for text and saves the image data list."""
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001", google_api_key=os.environ.get('GOOGLE_API_KEY'))
-        self.vector_store = Chroma.from_documents(chunks, embeddings, persist_directory="chroma_data")
+        # Identical chunks from the same page or row share an id and are stored once
+        unique_chunks = {}
+        for chunk in chunks:
+            unique_chunks.setdefault(_chunk_id(chunk), chunk)
+        ids = list(unique_chunks)
+        chunks = list(unique_chunks.values())
+
+        # Embed explicitly in batches so N chunks cost N / EMBED_BATCH_SIZE requests
+        texts = [chunk.page_content for chunk in chunks]
+        vectors = embeddings.embed_documents(texts, batch_size=EMBED_BATCH_SIZE)
+        for start in range(0, len(texts), EMBED_BATCH_SIZE):
+            end = start + EMBED_BATCH_SIZE
+            self.vector_store._collection.upsert(
+                ids=ids[start:end],
+                embeddings=vectors[start:end],
+                metadatas=[chunk.metadata for chunk in chunks[start:end]],
+                documents=texts[start:end]
+            )
+        stale_ids = set(self.vector_store._collection.get(include=[])["ids"]).difference(ids)
+        if stale_ids:
+            self.vector_store._collection.delete(ids=list(stale_ids))
         
         if images_data:
-            self.images_data = images_data
-            self._save_images_data()
+            self._save_images_data(images_data)
+            _load_image_index.cache_clear()
+        self._images = None
 
-    def _save_images_data(self):
-        """Saves the combined list of image data to a pickle file."""
-        with open("chroma_data/images_data.pkl", "wb") as f:
-            pickle.dump(self.images_data, f)
+        if signature is not None:
+            with open(INDEXED_SIGNATURE_FILE, "w") as f:
+                f.write(signature)
 
-    def _load_images_data(self):
-        """Loads the combined list of image data from a pickle file."""
+    def _save_images_data(self, images_data):
+        """
+        Saves the image metadata to a pickle file and the image bytes to a blob file.
+        Both are written to uniquely named temporary files and swapped in, so a blob
+        another session has memory-mapped is never truncated underneath it and
+        concurrent saves never replace each other's temporary files.
+        """
+        records = []
+        spans = []
+        offset = 0
+        blob_fd, blob_tmp = tempfile.mkstemp(dir=os.path.dirname(IMAGES_BLOB_FILE))
+        data_fd, data_tmp = tempfile.mkstemp(dir=os.path.dirname(IMAGES_DATA_FILE))
         try:
-            with open("chroma_data/images_data.pkl", "rb") as f:
-                self.images_data = pickle.load(f)
-        except FileNotFoundError:
-            self.images_data = []
-
-    def _load_vector_store(self):
-        """Loads the vector store and image data from disk if they haven't been loaded yet."""
-        if not self.vector_store:
-            embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001", google_api_key=os.environ.get('GOOGLE_API_KEY'))
-            self.vector_store = Chroma(persist_directory="chroma_data", embedding_function=embeddings)
-            self._load_images_data()
-            
+            with os.fdopen(blob_fd, "wb") as blob:
+                for img in images_data:
+                    blob.write(img.image_data)
+                    spans.append((offset, len(img.image_data)))
+                    offset += len(img.image_data)
+                    records.append(dataclasses.replace(img, image_data=None))
+            with os.fdopen(data_fd, "wb") as f:
+                pickle.dump({'records': records, 'spans': spans}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(blob_tmp, IMAGES_BLOB_FILE)
+            os.replace(data_tmp, IMAGES_DATA_FILE)
+        except BaseException:
+            for path in (blob_tmp, data_tmp):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+
+    def _ensure_images_loaded(self):
+        """Returns the image index, loading it on first use in this Retriever."""
+        if self._images is None:
+            try:
+                mtime = os.stat(IMAGES_DATA_FILE).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            self._images = _load_image_index(IMAGES_DATA_FILE, mtime)
+        return self._images
+
+    def _query_batcher(self):
+        return _get_query_batcher("chroma_data", EMBEDDING_MODEL, os.environ.get('GOOGLE_API_KEY'))
+
     def retrieve_relevant_docs(self, query, k=5):
         """Retrieves relevant text documents from the vector store based on similarity."""
-        self._load_vector_store()
-        return self.vector_store.similarity_search_with_score(query, k=k)
+        return self._query_batcher().search(query, k)
+
+    def retrieve_docs_and_images(self, query, k=5, max_images=1):
+        """
+        Retrieves the relevant text documents and images for a query. The Chroma search
+        (an embedding request plus a vector lookup) runs on the query batcher's thread while
+        images are scored on keywords; the retrieved-context bonus is applied once both finish.
+        """
+        docs_future = self._query_batcher().submit(query, k)
+        keyword_matches = self._match_image_keywords(query) if self._ensure_images_loaded().images_data else None
+        text_context = docs_future.result(timeout=QUERY_TIMEOUT)
+        return text_context, self._rank_images(keyword_matches, text_context, max_images)
 
     def get_relevant_images(self, query, text_context, max_images=1):
         """
         Finds the best-matching image using advanced scoring with stop-word
         filtering and phrase matching.
         """
-        self._load_vector_store()
-        if not self.images_data:
+        if not self._ensure_images_loaded().images_data:
             return []
+        return self._rank_images(self._match_image_keywords(query), text_context, max_images)
 
-        # --- CHANGE START ---
-        # The new logic is more robust.
-        MIN_RELEVANCE_SCORE = 10
-        
+    def _remove_stop_words(self, words):
+        """Drops stop phrases (greedy longest match) and single stop words from a word list."""
+        keywords = []
+        i = 0
+        while i < len(words):
+            for length in range(min(self._max_stop_phrase_len, len(words) - i), 1, -1):
+                if tuple(words[i:i + length]) in self._stop_phrases:
+                    i += length
+                    break
+            else:
+                if words[i] not in self.stop_words:
+                    keywords.append(words[i])
+                i += 1
+        return keywords
+
+    def _match_image_keywords(self, query):
+        """
+        Scores images on the query keywords alone through the inverted index. Returns
+        the cleaned query phrase with per-image keyword scores and match counts, or None
+        if the query only contained stop words or punctuation. Needs no retrieved text context.
+        """
         # Clean the query by removing stop words
-        query_lower = query.lower()
-        query_keywords = [word for word in query_lower.split() if word not in self.stop_words]
+        query_keywords = self._remove_stop_words(_normalize(query).split())
+        query_tokens = [token for keyword in query_keywords for token in _tokenize(keyword)]
+        if not query_tokens:
+            return None
         clean_query_phrase = " ".join(query_keywords)
 
-        if not query_keywords:
-            return [] # Return empty if the query only contained stop words
-        # --- CHANGE END ---
-        
-        relevant_pages = set()
-        if text_context:
-            for doc, score in text_context:
-                relevant_pages.add((doc.metadata.get('source'), doc.metadata.get('page')))
-
-        def score_image(img):
-            score = 0
-            description = (img.get('description', '') or '').lower()
-            label = (img.get('label', '') or '').lower()
-            product_name = (img.get('product_name', '') or '').lower()
-            
-            # --- CHANGE START: New Scoring Logic ---
+        keyword_scores = defaultdict(int)
+        matched_keywords = defaultdict(int)
+        for token in query_tokens:
+            # A field counts once per token, however many of its tokens contain it
+            for idx, weight in self._images.matches(token):
+                keyword_scores[idx] += weight
+                matched_keywords[idx] += 1
+        return clean_query_phrase, keyword_scores, matched_keywords
+
+    def _rank_images(self, keyword_matches, text_context, max_images):
+        """Adds the phrase, multi-keyword, context and Excel bonuses to the keyword scores and returns the top images."""
+        if keyword_matches is None:
+            return []
+        clean_query_phrase, keyword_scores, matched_keywords = keyword_matches
+        images = self._images
+        MIN_RELEVANCE_SCORE = 10
+
+        # The retrieved chunks were ranked by embedding similarity in Chroma, so an
+        # image on a retrieved page or for a retrieved product row is semantically
+        # relevant without any further embedding requests.
+        relevant_context = frozenset(
+            _context_key(doc.metadata.get('source'), doc.metadata.get('page'), doc.metadata.get('row_index'))
+            for doc, _ in (text_context or ())
+        )
+
+        # Only images with a field token containing a query token or tied to retrieved
+        # text can reach MIN_RELEVANCE_SCORE, so everything else is skipped. This covers
+        # the phrase bonus too: every word-character run of a phrase found in a name or
+        # label lies inside one of its tokens, so that image already has a keyword score.
+        candidates = set(keyword_scores)
+        for key in relevant_context:
+            candidates.update(images.context_index.get(key, ()))
+
+        def score_image(idx):
+            score = keyword_scores.get(idx, 0)
+
             # 1. Big bonus for exact phrase match (highest priority)
-            if clean_query_phrase in product_name or clean_query_phrase in label:
+            if clean_query_phrase in images.pname_lc[idx] or clean_query_phrase in images.label_lc[idx]:
                 score += 50
 
-            # 2. Score based on number of matching keywords
-            matched_keywords = 0
-            for keyword in query_keywords:
-                if keyword in description:
-                    score += 2
-                    matched_keywords += 1
-                if keyword in label:
-                    score += 5
-                    matched_keywords += 1
-                if keyword in product_name:
-                    score += 10
-                    matched_keywords += 1
-            
-            # 3. Bonus for matching multiple keywords
-            if matched_keywords > 1:
-                score += matched_keywords * 5
-            # --- CHANGE END ---
+            # 2. Bonus for matching multiple keywords
+            if matched_keywords.get(idx, 0) > 1:
+                score += matched_keywords[idx] * 5
 
-            if (img.get('source'), img.get('page')) in relevant_pages:
+            if not relevant_context.isdisjoint(images.context_keys[idx]):
                 score += 10
             
-            if 'row_index' in img:
+            if images.has_row_index[idx]:
                 score += 5
             
             return score
 
-        scored_images = [(img, score_image(img)) for img in self.images_data]
+        # Candidates are visited in load order so ties resolve as before
+        scored_images = [(idx, score_image(idx)) for idx in sorted(candidates)]
         
         scored_images = [si for si in scored_images if si[1] >= MIN_RELEVANCE_SCORE]
 
-        scored_images.sort(key=lambda x: x[1], reverse=True)
+        # Same result as a stable descending sort and slice, in O(N log k)
+        top_images = heapq.nlargest(max_images, scored_images, key=lambda x: x[1])
         
-        return [img for img, _ in scored_images[:max_images]]
+        return [images.with_image_bytes(idx) for idx, _ in top_images]
 
     def get_excel_doc_by_image(self, all_documents, image):
-        if 'row_index' not in image:
+        """Returns the Excel row document an image belongs to, or None for non-Excel images."""
+        if image.row_index is None:
             return None
-        
-        img_row_index = image.get('row_index')
-        img_source = image.get('source')
-
-        for doc in all_documents:
-            meta = doc.metadata
-            if meta.get('source') == img_source and meta.get('row_index') == img_row_index:
-                return doc
-        return None
+
+        # Index the documents by (source, row_index) once per documents list; the list
+        # itself is kept rather than its id(), which could be reused after collection.
+        if self._excel_docs_source is not all_documents:
+            self._excel_docs_index = {}
+            for doc in all_documents:
+                meta = doc.metadata
+                if 'row_index' in meta:
+                    self._excel_docs_index.setdefault((meta.get('source'), meta['row_index']), doc)
+            self._excel_docs_source = all_documents
+
+        return self._excel_docs_index.get((image.source, image.row_index))
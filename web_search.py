@@ -1,5 +1,27 @@
 import os
+import time
+import functools
+import requests
 from tavily import TavilyClient
+from tavily.errors import TimeoutError as TavilyTimeoutError
+
+# Transient failures (connection errors, timeouts, 5xx) are retried with exponential backoff
+SEARCH_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+
+# main() builds a new WebSearch on every Streamlit rerun, so the HTTP session is shared
+# per API key to keep its connections to the Tavily API alive between searches.
+@functools.lru_cache(maxsize=1)
+def _get_session(api_key):
+    """Returns the requests session the Tavily client sends its requests through."""
+    return requests.Session()
+
+def _is_transient(error):
+    """Returns True for errors worth retrying; bad keys and usage limits are not."""
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    # The client re-raises request timeouts as its own TimeoutError
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, TavilyTimeoutError, TimeoutError))
 
 class WebSearch:
     """
@@ -12,7 +34,7 @@ class WebSearch:
         self.api_key = os.environ.get('TAVILY_API_KEY')
         if not self.api_key:
             raise ValueError("TAVILY_API_KEY not found in environment variables.")
-        self.client = TavilyClient(api_key=self.api_key)
+        self.client = TavilyClient(api_key=self.api_key, session=_get_session(self.api_key))
 
     def search(self, query: str, max_results: int = 3) -> str:
         """
@@ -26,18 +48,40 @@ class WebSearch:
             str: A formatted string of the search results, or an error message.
         """
         try:
-            response = self.client.search(query=query, max_results=max_results)
+            response = self._search_with_retries(query, max_results)
             
             # Check if 'results' key exists and is not empty
             if 'results' in response and response['results']:
-                # Format the results into a string
-                results_str = "\n\n".join(
-                    [f"**Source:** {res['url']}\n**Content:** {res['content']}" for res in response['results']]
-                )
-                return results_str
+                # Format the results into a string, appending the pieces to a single buffer
+                parts = []
+                append = parts.append
+                for res in response['results']:
+                    if parts:
+                        append("\n\n")
+                    append("**Source:** ")
+                    append(res['url'])
+                    append("\n**Content:** ")
+                    append(res['content'])
+                return "".join(parts)
             else:
                 return "No web results found for the query."
                 
         except Exception as e:
             print(f"An error occurred during web search: {e}")
-            return "There was an error performing the web search."
\ No newline at end of file
+            return "There was an error performing the web search."
+
+    def _search_with_retries(self, query: str, max_results: int) -> dict:
+        """
+        Calls the Tavily API, retrying transient failures with exponential backoff.
+
+        Raises:
+            Exception: The last error, once attempts run out or if it is not transient.
+        """
+        for attempt in range(SEARCH_ATTEMPTS):
+            try:
+                return self.client.search(query=query, max_results=max_results)
+            except Exception as e:
+                if attempt == SEARCH_ATTEMPTS - 1 or not _is_transient(e):
+                    raise
+                print(f"Web search attempt {attempt + 1} failed, retrying: {e}")
+                time.sleep(RETRY_BASE_DELAY * 2 ** attempt)